@@ -23,21 +23,21 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
-import aiofiles.os
 import argparse
 import asyncio
+import cv2
+import numpy as np
 import os
+import sqlite3
 
 from random import randint, shuffle
 from PIL import Image, ImageFilter, ImageOps
 from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor
-from glob import iglob
-from multiprocessing import cpu_count
-from pyzbar.pyzbar import decode, ZBarSymbol
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from multiprocessing import cpu_count, freeze_support
 from sys import exit
-
-from itertools import product
+from zxingcpp import read_barcodes, BarcodeFormat
 
 __author__ = "Robert Northover <rfnorthover@gmail.com>"
 
@@ -66,6 +66,26 @@ ANGLES = [180, 90, 270, 10, 170, 75, 340]
 
 FILTERS = ["blur", "smooth"]
 
+# Images are downscaled to fit within this size before scanning, a QR code
+# is still easily detectable at this resolution
+MAX_SIZE = (1600, 1600)
+# ...and to this size for a second attempt if the first scan fails
+SMALL_SIZE = (800, 800)
+
+# Quarter turns can be performed as a lossless transpose rather than a
+# resampled rotation
+MAP_TRANSPOSE = {
+    90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_CLOCKWISE,
+}
+
+# Previously scanned images are remembered here, keyed by their absolute
+# path, modification time and size, so re-runs skip the expensive scan
+CACHE_FILE = ".qrcache.db"
+# Scans are committed to the cache in batches of this many
+CACHE_COMMIT_EVERY = 20
+
 MAP_FILTERS = dict(
     none=None,
     all="all",
@@ -76,162 +96,373 @@ MAP_FILTERS = dict(
     sharpen=ImageFilter.SHARPEN,
 )
 
+# The filters above as kernels for cv2.filter2D, which is vectorised where
+# PIL's filters are not
+MAP_KERNELS = {
+    name: np.array(kernel, np.float32).reshape(size[::-1]) / scale
+    for name, f in MAP_FILTERS.items() if hasattr(f, "filterargs")
+    for size, scale, _, kernel in [f.filterargs]
+}
+
+# Images are already scanned in parallel, one per worker process, so stop
+# OpenCV from starting a thread pool of its own in each of them
+cv2.setNumThreads(1)
+
+# A second, independent QR detector for images zxing can't read as is
+QR_DETECTOR = cv2.QRCodeDetector()
+# Contrast limited adaptive histogram equalisation, which evens out poorly lit
+# images
+CLAHE = cv2.createCLAHE(clipLimit=2.0)
+
 MONOCHROME = False
 
-def open_image(image_file: str, rotate: int = 1, filter: str = "blur") -> Image:
-    """ Loads the image at :image_file into memory """
+def open_image(image_file: str) -> np.ndarray:
+    """ Loads and decodes the image at :image_file into memory as a grayscale
+    array. PIL is only used here, as it can scale JPEGs down while decoding """
     try:
         img = Image.open(image_file)
+        # Let the JPEG decoder scale down while decoding where it can.
+        # Only luminance matters to the scanner, so work in grayscale
+        # throughout - a third of the pixels to rotate, filter and hand over
+        img.draft('L', MAX_SIZE)
+        img = img.convert('L')
+        img.thumbnail(MAX_SIZE, Image.BILINEAR)
         #img = ImageOps.autocontrast(img)
         #img = ImageOps.posterize(img, 4)
         #img = ImageOps.crop(img, border=400)
-
-        if rotate:
-            # NOTE: the blurring helps Zbar detect a QR code in some cases
-            img = img.rotate(rotate)#.filter(FILTER)
-
-        if filter and MAP_FILTERS.get(filter):
-            img = img.filter(MAP_FILTERS[filter])
-
-        if MONOCHROME:
-            #img = img.convert('1', dither=Image.NONE)
-            fn = lambda x : 255 if x > 90 else 0
-            img = img.convert('L').point(fn, mode='1')
-
-        #img.show()
-        return img
+        return np.asarray(img)
     except Exception as e:
         print(e)
 
+def rotate_image(img: np.ndarray, rotate: float) -> np.ndarray:
+    """ Returns a copy of the already loaded :img rotated by :rotate degrees """
+    if rotate % 360 in MAP_TRANSPOSE:
+        return cv2.rotate(img, MAP_TRANSPOSE[rotate % 360])
+    elif rotate:
+        # Rotate about the centre, keeping the original size as PIL did.
+        # Nearest neighbour is the cheapest resampling, and QR finder patterns
+        # survive its artifacts at these sizes
+        h, w = img.shape[:2]
+        matrix = cv2.getRotationMatrix2D((w / 2, h / 2), rotate, 1.0)
+        return cv2.warpAffine(img, matrix, (w, h), flags=cv2.INTER_NEAREST)
+    return img
+
+def transform_image(img: np.ndarray, rotate: float = 0, filter: str = None,
+                    monochrome: bool = MONOCHROME) -> np.ndarray:
+    """ Returns a copy of the already loaded :img rotated by :rotate degrees
+    with :filter applied, and converted to black and white if :monochrome """
+    img = rotate_image(img, rotate)
+
+    # NOTE: the blurring helps the scanner detect a QR code in some cases
+    if filter in MAP_KERNELS:
+        img = cv2.filter2D(img, -1, MAP_KERNELS[filter])
+
+    if monochrome:
+        # Pixels brighter than 90 become white, everything else black
+        _, img = cv2.threshold(img, 90, 255, cv2.THRESH_BINARY)
+
+    return img
+
 def find_images(directory: str) -> set:
     """ Finds the set of jpg files in the given directory not starting with
     the string 'UMMZI' """
-    images = set(iglob(directory + "/**/*.jpg", recursive=True))
-    images |= set(iglob(directory + "/**/*.jpeg", recursive=True))
-    images |= set(iglob(directory + "/**/image*.jpg", recursive=True))
-    images |= set(iglob(directory + "/**/*.JPG", recursive=True))
-    images |= set(iglob(directory + "/**/*.JEPG", recursive=True))
-    images -= set(iglob(directory + "/**/UMMZI*.jpg", recursive=True))
-    images -= set(iglob(directory + "/**/UMMZI*.JPG", recursive=True))
+    images = set()
+    # A single walk of the tree, skipping hidden files and directories as
+    # globbing would
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if name.startswith(".") or name.upper().startswith("UMMZI"):
+                continue
+            if name.lower().endswith((".jpg", ".jpeg")):
+                images.add(os.path.join(root, name))
 
     return images
 
-def _find_duplicates(results: [(str, str)]) -> dict:
-    """ Finds all duplicated QR codes given a list of file->QR
-    returns a dict of form: {QR: set(filenames containing QR)}
-    """
-    rev = defaultdict(set)
-    for orig, qr in results:
-        rev[qr].add(orig)
-    return dict(rev)
-
-def _file_mapping(images: [(str, str)]) -> dict:
-    """ Produce a dict of form:
-        {
-            <orig filename>: <QR.jpg>,
-            <filename 2>: <QR_copy{n}.jpg> in the case multiple images have the same QR
-            ...
-        }
-    """
-    images = _find_duplicates(images)
-    mapping = {}
-
-    for qr, files in images.items():
-        for i, f in enumerate(files):
-            directory = os.path.dirname(f)
-            copy = ".jpg" if i == 0 else f"_copy{i}.jpg"
-            mapping[f] = os.path.join(directory, f"{qr}{copy}")
-
-    return mapping
+def _decode(img: np.ndarray) -> str:
+    """ Returns the UMMZI QR code found in :img, or None """
+    qr = read_barcodes(img, formats=BarcodeFormat.QRCode)
+    if not qr:
+        return None
+
+    code = qr[0].text
+    if code.startswith("UMMZI"):
+        return code
+    # Some other QR code, which we report but otherwise ignore
+    print(code)
+
+def _skew_angle(img: np.ndarray) -> float:
+    """ Estimates how far :img is rotated from upright, in degrees, from the
+    median angle of the straight edges within it. QR finder patterns provide
+    plenty of these. Returns None if no edges could be found """
+    edges = cv2.Canny(img, 50, 150)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, 80, minLineLength=40, maxLineGap=10)
+    if lines is None or len(lines) == 0:
+        return None
+
+    x1, y1, x2, y2 = lines.reshape(-1, 4).T.astype(np.float32)
+    # Edges of a square are 90 degrees apart, so fold every angle into
+    # [-45, 45) before taking the median
+    angles = (np.degrees(np.arctan2(y2 - y1, x2 - x1)) + 45) % 90 - 45
+    return float(np.median(angles))
+
+def _detect(img: np.ndarray) -> str:
+    """ Returns the UMMZI QR code found in :img by OpenCV, or None """
+    found, codes, *_ = QR_DETECTOR.detectAndDecodeMulti(img)
+    if not found:
+        return None
+
+    for code in codes:
+        if code.startswith("UMMZI"):
+            return code
+
+def _scan(filename: str, base: np.ndarray, angles: [int], filters: [str],
+          monochrome: bool) -> str:
+    """ Tries each way of finding a QR in the loaded image :base in turn, from
+    the cheapest to the most expensive. Returns the UMMZI QR, or None """
+    # First we try to scan the unadulterated image
+    code = _decode(transform_image(base, monochrome=monochrome))
+    if code:
+        return code
+
+    # Blurring alone is the retry that most often succeeds, so try it before
+    # anything more involved
+    code = _decode(transform_image(base, filter="blur", monochrome=monochrome))
+    if code:
+        print(f"Successfully scanned image {filename} with blurring")
+        return code
+
+    # Then a smaller copy of the image, sized explicitly as scaling by a
+    # factor can round a thin image down to nothing
+    h, w = base.shape[:2]
+    scale = min(SMALL_SIZE[0] / w, SMALL_SIZE[1] / h, 1.0)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    small = cv2.resize(base, size, interpolation=cv2.INTER_AREA)
+    code = _decode(transform_image(small, monochrome=monochrome))
+    if code:
+        print(f"Successfully scanned image {filename} at reduced size")
+        return code
+
+    # Then OpenCV's detector, which copes with some images zxing doesn't
+    code = _detect(base)
+    if code:
+        print(f"Successfully scanned image {filename} with OpenCV")
+        return code
+
+    # Then with the contrast equalised
+    code = _decode(transform_image(CLAHE.apply(base), monochrome=monochrome))
+    if code:
+        print(f"Successfully scanned image {filename} with equalised contrast")
+        return code
+
+    # Then straighten the image using its estimated skew, which usually
+    # saves sweeping through every angle
+    skew = _skew_angle(base)
+    if skew:
+        code = _decode(transform_image(base, rotate=skew, monochrome=monochrome))
+        if code:
+            print(f"Successfully scanned image {filename} with {skew:.1f} degrees of rotation")
+            return code
+
+    # Reorienting the image by a quarter turn is cheap, so try that first
+    for degrees in angles:
+        if degrees % 360 not in MAP_TRANSPOSE:
+            continue
+        print(f".\t", end="")
+        code = _decode(transform_image(base, rotate=degrees, monochrome=monochrome))
+        if code:
+            print(f"Successfully scanned image {filename} with {degrees} degrees of rotation")
+            return code
+
+    # Still no QR detected, so we try rotating and blurring the image
+    for degrees in angles:
+        # Rotate image :degrees once, and share it between the filters
+        rotated = rotate_image(base, degrees)
+        for name in filters:
+            print(f".\t", end="")
+            # Blur, and try again
+            code = _decode(transform_image(rotated, filter=name, monochrome=monochrome))
+            if code:
+                print(f"Successfully scanned image {filename} with {degrees} degrees of rotation")
+                return code
 
-def qr_code(filename: str) -> (str, str):
-    """ Attempt to retreive the QR from image :filename """
+def qr_code(filename: str, angles: [int] = ANGLES, filters: [str] = FILTERS,
+            monochrome: bool = MONOCHROME) -> (str, str):
+    """ Attempt to retreive the QR from image :filename, retrying with the
+    image rotated by each of :angles and with each of :filters applied """
 
     print(f"Scanning {filename}")
-    img = open_image(filename)
-    if not img:
+    # Decode the file once, every retry below only transforms this copy
+    base = open_image(filename)
+    if base is None:
         # If the image couldn't be loaded, return the filename twice
         # e.g. oldname == newname
         return filename, os.path.splitext(os.path.basename(filename))[0]
 
     try:
-        # First we try to scan the unadulterated image
-        qr = decode(img)
-        code = qr[0].data.decode('utf-8')
-        if not code.startswith("UMMZI"):
-            print(qr[0])
-            raise IndexError("Empty code")
-
+        code = _scan(filename, base, angles, filters, monochrome)
+    except Exception as e:
+        # Don't let one troublesome image abort the whole directory
+        print(f"Failed to scan {filename}: {e}")
+        code = None
+    if code:
         # return the original filename and the extracted QR
         return filename, code
-    except IndexError as e:
-        # No QR detected, so we try rotating and blurring the image
-        for degrees, filters in product(ANGLES, FILTERS):
-            print(f".\t", end="")
-            try:
-                # Rotate image :degrees, blur, and try again
-                img = open_image(filename, rotate=degrees, filter=filters)
-                qr = decode(img)
-                if len(qr) > 0:
-                    print(f"Successfully scanned image {filename} with {degrees} degrees of rotation")
-                code = qr[0].data.decode('utf-8')
-                if not code.startswith("UMMZI"):
-                    print(qr[0])
-                    raise IndexError("Empty code")
-                return filename, code
-            except IndexError as err:
-                pass
-
-        # Failed to scan, so just return the filename twice
-        # We should really return None here and filter it out later...
-        return filename, os.path.splitext(os.path.basename(filename))[0]
 
-async def get_qr_codes(executor: ThreadPoolExecutor, directory: str) -> list:
-    """For the specified :directory, execute the QR scanner for any detected
-    images. These scans are performed asyncronously via the :executor"""
+    # Failed to scan, so just return the filename twice
+    # We should really return None here and filter it out later...
+    return filename, os.path.splitext(os.path.basename(filename))[0]
+
+def make_scanner(angles: [int], filters: [str], monochrome: bool):
+    """ Returns qr_code with the given settings bound to it. A partial rather
+    than a closure, as it must be pickled to reach the worker processes """
+    return partial(qr_code, angles=angles, filters=filters, monochrome=monochrome)
+
+def open_cache(cache_file: str) -> sqlite3.Connection:
+    """ Opens (creating if necessary) the scan cache at :cache_file """
+    cache = sqlite3.connect(cache_file)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS scans "
+        "(path TEXT PRIMARY KEY, mtime REAL, size INT, qr TEXT)"
+    )
+    return cache
+
+def prune_cache(cache: sqlite3.Connection) -> None:
+    """ Removes rows from the :cache for images that no longer exist, i.e.
+    those that have since been renamed """
+    paths = [path for path, in cache.execute("SELECT path FROM scans")]
+    cache.executemany(
+        "DELETE FROM scans WHERE path = ?",
+        [(path,) for path in paths if not os.path.lexists(path)]
+    )
+    cache.commit()
+
+async def get_qr_codes(executor: Executor, directory: str,
+                       scanner=qr_code, cache: sqlite3.Connection = None):
+    """For the specified :directory, execute the QR :scanner for any detected
+    images. These scans are performed asyncronously via the :executor and
+    each (filename, QR) pair is yielded as soon as its scan completes.
+    Images found unchanged in the :cache are not scanned again"""
 
     unscanned = find_images(directory)
     if len(unscanned) == 0:
         exit(f"No unscanned images detected in {directory} - Aborting")
 
-    # Scan concurrently depending on the number of threads specified
+    cached = []
+    stats = {}
+    if cache:
+        for img in unscanned:
+            try:
+                st = os.stat(img)
+            except OSError:
+                # e.g. a dangling symlink, or removed since the walk. Leave
+                # it to the scanner, which reports it and keeps its name
+                continue
+            stats[img] = (os.path.abspath(img), st.st_mtime, st.st_size)
+            row = cache.execute(
+                "SELECT qr FROM scans WHERE path = ? AND mtime = ? AND size = ?",
+                stats[img]
+            ).fetchone()
+            if row:
+                cached.append((img, row[0]))
+        unscanned -= {img for img, _ in cached}
+
+    # Scan concurrently depending on the number of workers specified
     loop = asyncio.get_event_loop()
     tasks = [
-        loop.run_in_executor(executor, qr_code, img)
+        loop.run_in_executor(executor, scanner, img)
         for img in unscanned 
     ]
-    completed, pending = await asyncio.wait(tasks)
-    return [qr.result() for qr in completed]
 
+    for result in cached:
+        print(f"Using cached QR for {result[0]}")
+        yield result
 
-# Asynchronously wrap common os functions
-_rename = aiofiles.os.wrap(os.rename)
-_exists = aiofiles.os.wrap(os.path.exists)
-
-async def rename_image(old: str, new: str) -> None:
-    """ Aynchronously rename file :old to :new if it doesn't exist """
-    exists = await _exists(new)
-    if not exists:
-        print(f"Renaming {old} -> {new}")
-        await _rename(old, new)
-
-def main(dirs: [str], workers: int) -> None:
-    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for i, qr in enumerate(asyncio.as_completed(tasks), 1):
+            orig, code = await qr
+            if cache and orig in stats:
+                cache.execute(
+                    "INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?)",
+                    (*stats[orig], code)
+                )
+                if i % CACHE_COMMIT_EVERY == 0:
+                    cache.commit()
+            yield orig, code
+    finally:
+        if cache:
+            cache.commit()
+
+
+def _batch_rename(renames: [(str, str)]) -> None:
+    """ Rename each file old -> new in :renames, unless new already exists """
+    for old, new in renames:
+        if not os.path.lexists(new):
+            print(f"Renaming {old} -> {new}")
+            os.rename(old, new)
+
+async def rename_images(executor: Executor, directory: str,
+                        scanner=qr_code, cache: sqlite3.Connection = None) -> None:
+    """ Scan the images in :directory and rename each one as soon as its QR
+    is known. The first image found with a given QR is renamed to <QR.jpg>,
+    any further images with the same QR to <QR_copy{n}.jpg> """
+    # Only the number of images seen so far for each QR is needed
+    counts = defaultdict(int)
     loop = asyncio.get_event_loop()
+    # Renames are handed to a thread in batches, one batch at a time. Any
+    # that arrive while a batch is in progress are queued for the next
+    pending = []
+    batch = None
+
+    scans = get_qr_codes(executor, directory, scanner, cache)
+    try:
+        async for orig, qr in scans:
+            i = counts[qr]
+            counts[qr] += 1
+            copy = ".jpg" if i == 0 else f"_copy{i}.jpg"
+            pending.append((orig, os.path.join(os.path.dirname(orig), f"{qr}{copy}")))
+
+            # Rename while the remaining scans are still running
+            if batch is None or batch.done():
+                if batch:
+                    batch.result()
+                batch = loop.run_in_executor(None, _batch_rename, pending)
+                pending = []
+    finally:
+        # Close the scans here, rather than leaving it to the garbage
+        # collector, so the cache is committed even if renaming fails
+        await scans.aclose()
+
+    if batch:
+        await batch
+    if pending:
+        await loop.run_in_executor(None, _batch_rename, pending)
+
+def main(dirs: [str], workers: int, angles: [int] = ANGLES,
+         filters: [str] = FILTERS, monochrome: bool = MONOCHROME,
+         cache_file: str = CACHE_FILE) -> None:
+    scanner = make_scanner(angles, filters, monochrome)
+    cache = open_cache(cache_file) if cache_file else None
+    # Scanning is CPU bound, so use processes to sidestep the GIL
+    executor = ProcessPoolExecutor(max_workers=workers)
     try:
         for directory in dirs:
-            results = loop.run_until_complete(
-                get_qr_codes(executor, directory)
-            )
-
-            images = _file_mapping(results)
-            rename_tasks = asyncio.gather(*(rename_image(old, new) for old, new in images.items()))
-            loop.run_until_complete(rename_tasks)
+            # asyncio.run cancels the scan and closes its generators cleanly,
+            # even on Ctrl-C, before the loop is closed
+            asyncio.run(rename_images(executor, directory, scanner, cache))
+        if cache:
+            prune_cache(cache)
     finally:
-        loop.close()
+        if cache:
+            # Keep whatever was scanned before an error or Ctrl-C
+            cache.commit()
+            cache.close()
+        # Don't wait for scans still queued if we were interrupted
+        executor.shutdown(cancel_futures=True)
 
 
 if __name__ == "__main__":
+    freeze_support()
     cores = cpu_count()
     parser = argparse.ArgumentParser(description='Rename files based upon their QR codes')
     parser.add_argument('directories',
@@ -262,17 +493,21 @@ if __name__ == "__main__":
                         dest='threads',
                         type=int,
                         default=cores,
-                        help='How many threads to use - Defaults to the number of cores on the system')
+                        help='How many worker processes to use - Defaults to the number of cores on the system')
+    parser.add_argument('-n', '--no-cache',
+                        dest='no_cache',
+                        action='store_true',
+                        help=f'Rescan every image, ignoring previous results stored in {CACHE_FILE}')
     
     args = parser.parse_args()
 
-    FILTERS = args.filters
+    filters = args.filters
     if "all" in args.filters:
-        FILTERS = [f for f in MAP_FILTERS.keys() if f not in ["all", "none"]]
-        
-        
-    ANGLES = args.angles
-    MONOCHROME = args.MONOCHROME
+        filters = [f for f in MAP_FILTERS.keys() if f not in ["all", "none"]]
 
-    main(args.directories, args.threads)
+    main(args.directories, args.threads,
+         angles=args.angles,
+         filters=filters,
+         monochrome=args.MONOCHROME,
+         cache_file=None if args.no_cache else CACHE_FILE)
 